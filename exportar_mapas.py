@@ -0,0 +1,217 @@
+"""Exporta un mapa HTML independiente por EPS (y por perfil de pesos).
+
+Los mapas se renderizan en paralelo con un pool de procesos. Las librerías
+JS/CSS y las capas comunes (límite departamental y buffers) se escriben una
+sola vez en ``<salida>/assets``; cada página solo contiene las capas de su EPS.
+
+Uso:
+    python exportar_mapas.py --salida mapas --perfiles perfiles.json
+"""
+import argparse
+import json
+import os
+import re
+import urllib.parse
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from branca.element import MacroElement
+from folium.elements import JSCSSMixin
+from jinja2 import Template
+from unidecode import unidecode
+
+from index import (
+    ARCHIVO_BASE, CAPAS_BASE, ZOOM_PUNTOS, actualizar_datos, calculate_sectional_ranking, construir_mapa,
+    default_weights, estado_datos, sections
+)
+
+CARPETA_ASSETS = "assets"
+
+class CapasBase(JSCSSMixin, MacroElement):
+    # Carga las capas comunes desde assets/capas_base.js en lugar de incrustarlas
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            agregarCapasBase({{ this.mapa }}, {{ this.control }});
+        {% endmacro %}
+    """)
+
+    def __init__(self, ruta_js, mapa, control=None):
+        super().__init__()
+        self._name = "CapasBase"
+        self.default_js = [("capas_base", ruta_js)]
+        self.mapa = mapa.get_name()
+        self.control = control.get_name() if control is not None else "null"
+
+def nombre_archivo(texto):
+    return re.sub(r"[^A-Za-z0-9]+", "_", unidecode(str(texto))).strip("_")
+
+def escribir_capas_base(datos, carpeta):
+    # Un solo archivo JS con las capas comunes y su estilo ya calculado por feature
+    capas = []
+    for nombre, (titulo, estilo) in CAPAS_BASE.items():
+        gdf = datos.capas.get(nombre)
+        if gdf is None or gdf.empty:
+            continue
+        geojson = json.loads(gdf.to_json())
+        for feature in geojson["features"]:
+            feature["properties"]["_estilo"] = estilo(feature)
+        capas.append({"nombre": titulo, "geojson": geojson})
+
+    etiquetas = []
+    departamentos = datos.capas.get("departamento")
+    if departamentos is not None and not departamentos.empty:
+        for _, row in departamentos.iterrows():
+            centroide = row.geometry.centroid
+            etiquetas.append([centroide.y, centroide.x, row["nomdep"]])
+
+    with open(os.path.join(carpeta, "capas_base.js"), "w", encoding="utf-8") as f:
+        f.write(f"var CAPAS_BASE = {json.dumps(capas)};\n")
+        f.write(f"var ETIQUETAS_DEPARTAMENTO = {json.dumps(etiquetas)};\n")
+        f.write("""
+function agregarCapasBase(mapa, control) {
+    CAPAS_BASE.forEach(function (capa) {
+        var layer = L.geoJson(capa.geojson, {
+            style: function (feature) { return feature.properties._estilo; }
+        }).addTo(mapa);
+        // Debajo de los puntos para no tapar sus popups
+        layer.bringToBack();
+        if (control) { control.addOverlay(layer, capa.nombre); }
+    });
+    ETIQUETAS_DEPARTAMENTO.forEach(function (etiqueta) {
+        L.marker([etiqueta[0], etiqueta[1]], {
+            icon: L.divIcon({
+                className: "empty",
+                html: "<div style='font-size: 10px; color: black;'>" + etiqueta[2] + "</div>"
+            })
+        }).addTo(mapa);
+    });
+}
+""")
+
+# Referencias url(...) dentro de una hoja de estilos
+URL_CSS = re.compile(r"""url\(\s*['"]?([^'")]+?)['"]?\s*\)""")
+
+def ruta_vendor(url):
+    # vendor/<host>/<ruta>: conserva la estructura del CDN para que los url() relativos sigan valiendo
+    partes = urllib.parse.urlsplit(url)
+    return "/".join(["vendor", partes.netloc.replace(":", "_")] + [p for p in partes.path.split("/") if p])
+
+def descargar(url, carpeta):
+    # Descarga url en su ruta de vendor (una sola vez) y devuelve (ruta relativa, destino)
+    ruta = ruta_vendor(url)
+    destino = os.path.join(carpeta, *ruta.split("/"))
+    if not os.path.exists(destino):
+        with urllib.request.urlopen(url, timeout=30) as respuesta:
+            contenido = respuesta.read()
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        with open(destino, "wb") as f:
+            f.write(contenido)
+    return ruta, destino
+
+def descargar_librerias(html, carpeta):
+    """Descarga una vez las librerías JS/CSS referenciadas por el HTML.
+
+    Las hojas de estilos se descargan junto con los recursos relativos que
+    cargan con ``url()`` (imágenes, fuentes), respetando la estructura de
+    carpetas del CDN. Devuelve un diccionario URL -> ruta relativa a
+    ``assets``; las URLs que no se pueden descargar completas se omiten y las
+    páginas siguen usando el CDN.
+    """
+    urls = re.findall(r'<script src="(https?://[^"]+)"', html) + \
+           re.findall(r'<link rel="stylesheet" href="(https?://[^"]+)"', html)
+    locales = {}
+    for url in dict.fromkeys(urls):
+        try:
+            ruta, destino = descargar(url, carpeta)
+            if ruta.endswith(".css"):
+                with open(destino, encoding="utf-8", errors="ignore") as f:
+                    referencias = URL_CSS.findall(f.read())
+                for referencia in dict.fromkeys(referencias):
+                    if referencia.startswith(("data:", "#", "//")) or urllib.parse.urlsplit(referencia).scheme:
+                        continue
+                    descargar(urllib.parse.urldefrag(urllib.parse.urljoin(url, referencia))[0], carpeta)
+        except OSError as e:
+            print(f"⚠️ No se pudo descargar {url}: {e}")
+            continue
+        locales[url] = ruta
+    return locales
+
+def renderizar(datos, pesos, eps, top_n, zoom, prefijo_assets):
+    ranking_cols = datos.ranking_cols
+    pesos = {col: pesos.get(col, default_weights.get(col, 1)) for col in ranking_cols}
+    df_eps = datos.particiones[eps].reset_index()
+    df_filtered = calculate_sectional_ranking(df_eps, ranking_cols, pesos, sections)
+
+    # Las páginas son estáticas: siempre llevan los puntos individuales, sin
+    # importar el zoom inicial
+    m, control = construir_mapa(datos, df_filtered, eps, top_n, zoom, capas_base=False,
+                                zoom_grilla=ZOOM_PUNTOS)
+    CapasBase(f"{prefijo_assets}/capas_base.js", m, control).add_to(m)
+    return m.get_root().render()
+
+# Estado de cada proceso del pool: datos cargados una sola vez por proceso
+_trabajo = {}
+
+def _iniciar_proceso(locales, opciones):
+    _trabajo.update(datos=actualizar_datos(estado_datos()), locales=locales, **opciones)
+
+def _exportar(perfil, pesos, eps):
+    prefijo = f"../{CARPETA_ASSETS}"
+    html = renderizar(_trabajo["datos"], pesos, eps,
+                      _trabajo["top_n"], _trabajo["zoom"], prefijo)
+    for url, ruta in _trabajo["locales"].items():
+        html = html.replace(url, f"{prefijo}/{ruta}")
+    ruta = os.path.join(_trabajo["salida"], nombre_archivo(perfil), f"{nombre_archivo(eps)}.html")
+    with open(ruta, "w", encoding="utf-8") as f:
+        f.write(html)
+    return ruta, len(html.encode("utf-8"))
+
+def main():
+    parser = argparse.ArgumentParser(description="Exporta un mapa HTML por EPS.")
+    parser.add_argument("--salida", default="mapas", help="Carpeta de salida")
+    parser.add_argument("--perfiles", help="JSON con perfiles de pesos: {nombre: {columna: peso}}")
+    parser.add_argument("--top", type=int, default=10, help="Top N resaltado en cada mapa")
+    parser.add_argument("--zoom", type=int, default=12, help="Zoom inicial de los mapas (solo la vista; los puntos no se agregan)")
+    parser.add_argument("--procesos", type=int, default=None, help="Procesos del pool")
+    parser.add_argument("--sin-descarga", action="store_true",
+                        help="Usar las librerías JS/CSS desde el CDN sin descargarlas")
+    args = parser.parse_args()
+
+    perfiles = {"predeterminado": default_weights}
+    if args.perfiles:
+        with open(args.perfiles, encoding="utf-8") as f:
+            perfiles = json.load(f)
+
+    datos = actualizar_datos(estado_datos())
+    if datos.tabla is None:
+        raise SystemExit(f"❌ No se pudo cargar {ARCHIVO_BASE}")
+    eps_options = list(datos.particiones.keys())
+
+    carpeta_assets = os.path.join(args.salida, CARPETA_ASSETS)
+    os.makedirs(carpeta_assets, exist_ok=True)
+    for perfil in perfiles:
+        os.makedirs(os.path.join(args.salida, nombre_archivo(perfil)), exist_ok=True)
+
+    # Assets compartidos: se escriben una sola vez para todas las páginas
+    escribir_capas_base(datos, carpeta_assets)
+    locales = {}
+    if not args.sin_descarga and eps_options:
+        pesos = next(iter(perfiles.values()))
+        muestra = renderizar(datos, pesos, eps_options[0], args.top, args.zoom, CARPETA_ASSETS)
+        locales = descargar_librerias(muestra, carpeta_assets)
+
+    opciones = {"salida": args.salida, "top_n": args.top, "zoom": args.zoom}
+    total = 0
+    with ProcessPoolExecutor(max_workers=args.procesos, initializer=_iniciar_proceso,
+                             initargs=(locales, opciones)) as pool:
+        futuros = [pool.submit(_exportar, perfil, pesos, eps)
+                   for perfil, pesos in perfiles.items() for eps in eps_options]
+        for futuro in as_completed(futuros):
+            ruta, tamano = futuro.result()
+            total += tamano
+            print(f"✅ {ruta} ({tamano / 1024:.0f} KB)")
+
+    print(f"📦 {len(futuros)} mapas exportados en {args.salida} ({total / 1024:.0f} KB en páginas)")
+
+if __name__ == "__main__":
+    main()
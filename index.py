@@ -1,10 +1,16 @@
+import hashlib
+import os
+import threading
+from collections import namedtuple
 import streamlit as st
 import pandas as pd
 import geopandas as gpd
 import folium
 import plotly.express as px
+import numpy as np
 from folium.plugins import Fullscreen
 import leafmap.foliumap as leafmap
+from streamlit_folium import st_folium
 from unidecode import unidecode
 
 # Diccionario de pesos predeterminado
@@ -42,11 +48,38 @@ sections = {
     "Distancia a la EP":['Distancia a la EP']
 }
 
+# Archivos de ./data vigilados para la recarga en caliente
+RUTA_DATOS = "./data"
+ARCHIVO_BASE = "base_app_final.xlsx"
+CAPAS_GEOJSON = {
+    "datass": "datass.geojson",
+    "departamento": "departamento.geojson",
+    "casco_urbano": "Buffer_EPS_casco_urbano.geojson",
+    "casco_no_urbano": "Buffer_EPS_casco_no_urbano.geojson",
+    "censo": "censo.geojson"
+}
+# Capas de puntos que se particionan por EPS (columnas usadas en los popups)
+CAPAS_PUNTOS = {
+    "datass": ["nomprest", "EPS1"],
+    "censo": ["NOMCCPP"]
+}
+CLAVE_PRESTADOR = "codigodeprestador"
+
+# Agregación en grilla: a partir de este zoom se envían los puntos individuales
+ZOOM_PUNTOS = 11
+# Zoom inicial del mapa y zoom mínimo permitido (nivel más grueso de la pirámide)
+ZOOM_INICIAL = 12
+ZOOM_MIN = 5
+# Niveles de la pirámide (celdas de 360 / 2**(nivel + 3) grados); cada nivel se
+# usa en dos zooms consecutivos para no volver a montar el mapa en cada paso
+NIVELES_GRILLA = list(range(ZOOM_MIN, ZOOM_PUNTOS, 2))
+NIVEL_MAX_GRILLA = NIVELES_GRILLA[-1]
+
 def load_data(file):
     df = pd.read_excel(file, engine="openpyxl")
     df["Prestador"] = df["Prestador"].apply(lambda x: unidecode(str(x)))
     ranking_cols = df.loc[:, 'Índice de servicios brindados':'Distancia a la EP'].columns
-    df = df[['Prestador', 'LONGITUD', 'LATITUD','EPS'] + list(ranking_cols)]
+    df = df[[CLAVE_PRESTADOR, 'Prestador', 'LONGITUD', 'LATITUD','EPS'] + list(ranking_cols)]
     return df, ranking_cols
 
 # def calculate_ranking(df, ranking_cols, weights):
@@ -114,40 +147,432 @@ def generate_formula(weights):
     """
     return formula
 
-@st.cache_data
-def cargar_geojson_local(ruta, nombre):
-    try:
-        geojson_data = gpd.read_file(ruta)
-        return geojson_data
-    except Exception as e:
-        st.error(f"❌ Error al cargar {nombre}: {e}")
+def cargar_geojson_local(ruta):
+    # Un archivo inexistente es una capa vacía; los errores de lectura se propagan
+    if not os.path.exists(ruta):
         return gpd.GeoDataFrame()
+    return gpd.read_file(ruta)
+    
+def particionar_puntos(geojson_data, columnas):
+    # Puntos de una capa GeoJSON separados por EPS: {EPS: DataFrame}
+    if not isinstance(geojson_data, gpd.GeoDataFrame) or geojson_data.empty:
+        return {}
+    points = geojson_data[geojson_data.geometry.type == "Point"]
+    puntos = pd.DataFrame(points[list(dict.fromkeys(columnas + ["EPS1"]))])
+    puntos["LONGITUD"] = points.geometry.x
+    puntos["LATITUD"] = points.geometry.y
+    return {eps: grupo.reset_index(drop=True) for eps, grupo in puntos.groupby("EPS1")}
+
+def construir_piramide(puntos, columna_valor=None):
+    """Agrupa los puntos en una pirámide jerárquica de celdas (estilo geohash).
+
+    Cada nivel divide las celdas del nivel anterior en cuatro; el nivel ``z``
+    corresponde al zoom ``z`` del mapa; solo se guardan los ``NIVELES_GRILLA``.
+    Devuelve un diccionario nivel -> DataFrame con el
+    centroide de los puntos de cada celda (ponderado por cantidad), el número
+    de puntos y el promedio de ``columna_valor``.
+    """
+    if puntos.empty:
+        return {}
+
+    tamano_fino = 360 / 2 ** (NIVEL_MAX_GRILLA + 3)
+    celdas = pd.DataFrame({
+        "ix": np.floor((puntos["LONGITUD"].to_numpy() + 180) / tamano_fino).astype(np.int64),
+        "iy": np.floor((puntos["LATITUD"].to_numpy() + 90) / tamano_fino).astype(np.int64),
+        "LONGITUD": puntos["LONGITUD"].to_numpy(),
+        "LATITUD": puntos["LATITUD"].to_numpy(),
+    })
+    if columna_valor is not None:
+        celdas["Valor"] = puntos[columna_valor].to_numpy()
+
+    # Nivel más fino a partir de los puntos; los siguientes a partir del nivel anterior
+    nivel = celdas.assign(Cantidad=1, Suma=celdas.get("Valor", 0))
+    piramide = {}
+    for z in range(NIVEL_MAX_GRILLA, ZOOM_MIN - 1, -1):
+        if z < NIVEL_MAX_GRILLA:
+            nivel = nivel.assign(ix=nivel["ix"] // 2, iy=nivel["iy"] // 2)
+            # Centro ponderado por la cantidad de puntos de cada subcelda
+            nivel["LONGITUD"] = nivel["LONGITUD"] * nivel["Cantidad"]
+            nivel["LATITUD"] = nivel["LATITUD"] * nivel["Cantidad"]
+            nivel = nivel.groupby(["ix", "iy"], as_index=False).agg(
+                {"LONGITUD": "sum", "LATITUD": "sum", "Cantidad": "sum", "Suma": "sum"}
+            )
+            nivel["LONGITUD"] = nivel["LONGITUD"] / nivel["Cantidad"]
+            nivel["LATITUD"] = nivel["LATITUD"] / nivel["Cantidad"]
+        else:
+            nivel = nivel.groupby(["ix", "iy"], as_index=False).agg(
+                {"LONGITUD": "mean", "LATITUD": "mean", "Cantidad": "sum", "Suma": "sum"}
+            )
+        resultado = nivel[["LONGITUD", "LATITUD", "Cantidad"]].copy()
+        if columna_valor is not None:
+            resultado["Promedio"] = nivel["Suma"] / nivel["Cantidad"]
+        if z in NIVELES_GRILLA:
+            piramide[z] = resultado
+    return piramide
+
+@st.cache_data(max_entries=64)
+def piramide_capa(_puntos, capa, eps, hash_capa):
+    # Pirámide de una capa de puntos fija (DATASS, CENSO); se cachea por el hash
+    # del archivo de la capa, así solo se recalcula cuando cambia esa capa
+    return construir_piramide(_puntos)
+
+def agregar_celdas(layer, celdas, color, etiqueta_valor=None):
+    # Un CircleMarker por celda, con radio según la cantidad de puntos
+    for _, row in celdas.iterrows():
+        cantidad = int(row["Cantidad"])
+        popup_content = f"<b>Puntos:</b> {cantidad}"
+        if etiqueta_valor is not None:
+            popup_content += f"<br><b>{etiqueta_valor}:</b> {row['Promedio']:.2f}"
+        folium.CircleMarker(
+            location=[row["LATITUD"], row["LONGITUD"]],
+            radius=4 + 3 * np.log2(cantidad),
+            color=color,
+            fill=True,
+            fill_color=color,
+            fill_opacity=0.5,
+            popup=folium.Popup(popup_content, max_width=300)
+        ).add_to(layer)
+
+def firma_archivo(ruta, anterior=None):
+    """Devuelve ``(mtime, tamaño, sha256)`` del archivo, o ``None`` si no existe.
+
+    Si la fecha de modificación y el tamaño coinciden con la firma ``anterior``
+    se reutiliza su hash sin volver a leer el archivo.
+    """
+    try:
+        info = os.stat(ruta)
+        if anterior is not None and anterior[:2] == (info.st_mtime, info.st_size):
+            return anterior
+        sha = hashlib.sha256()
+        with open(ruta, "rb") as f:
+            for bloque in iter(lambda: f.read(1 << 20), b""):
+                sha.update(bloque)
+    except FileNotFoundError:
+        return None
+    return (info.st_mtime, info.st_size, sha.hexdigest())
+
+# Versión inmutable de los datos: se publica completa con una sola asignación.
+# ``hashes`` guarda el hash de contenido de cada capa cargada y ``errores`` los
+# archivos que no se pudieron cargar (archivo -> mensaje).
+Datos = namedtuple("Datos", ["version", "tabla", "ranking_cols", "particiones", "capas", "puntos",
+                             "hashes", "errores"])
+
+@st.cache_resource
+def estado_datos():
+    # Estado compartido entre todas las sesiones; se actualiza con actualizar_datos
+    return {
+        "lock": threading.Lock(),
+        "firmas": {},
+        "datos": Datos(version=0, tabla=None, ranking_cols=None, particiones={}, capas={}, puntos={},
+                       hashes={}, errores={})
+    }
+
+def actualizar_tabla(datos, ruta):
+    """Recarga la base de prestadores y aplica solo las filas que cambiaron.
+
+    Las filas se comparan por ``CLAVE_PRESTADOR``; únicamente se recalculan las
+    particiones de las EPS afectadas por filas nuevas, eliminadas o modificadas.
+    Devuelve ``(tabla, ranking_cols, particiones)`` sin modificar ``datos``.
+    """
+    nuevo, ranking_cols = load_data(ruta)
+    duplicadas = nuevo.loc[nuevo[CLAVE_PRESTADOR].duplicated(), CLAVE_PRESTADOR].unique()
+    if len(duplicadas):
+        raise ValueError(f"{CLAVE_PRESTADOR} repetido: {', '.join(map(str, duplicadas[:5]))}")
+    nuevo = nuevo.set_index(CLAVE_PRESTADOR)
+    anterior = datos.tabla
+
+    if anterior is None or list(anterior.columns) != list(nuevo.columns):
+        # Primera carga o cambio de estructura: se reconstruye todo
+        particiones = {eps: grupo for eps, grupo in nuevo.groupby("EPS", sort=False)}
+        return nuevo, ranking_cols, particiones
+
+    eliminadas = anterior.index.difference(nuevo.index)
+    agregadas = nuevo.index.difference(anterior.index)
+    comunes = nuevo.index.intersection(anterior.index)
+    previo, actual = anterior.loc[comunes], nuevo.loc[comunes]
+    iguales = (previo == actual) | (previo.isna() & actual.isna())
+    modificadas = comunes[~iguales.all(axis=1)]
+
+    if eliminadas.empty and agregadas.empty and modificadas.empty:
+        return anterior, datos.ranking_cols, datos.particiones
+
+    eps_afectadas = set(anterior.loc[eliminadas.union(modificadas), "EPS"]) | \
+                    set(nuevo.loc[agregadas.union(modificadas), "EPS"])
+
+    # La tabla nueva es la del archivo (con sus tipos); solo las particiones de
+    # las EPS afectadas se reconstruyen, las demás se reutilizan tal cual
+    tabla = nuevo
+
+    particiones = dict(datos.particiones)
+    for eps in eps_afectadas:
+        grupo = tabla[tabla["EPS"] == eps]
+        if grupo.empty:
+            particiones.pop(eps, None)
+        else:
+            particiones[eps] = grupo
+    return tabla, datos.ranking_cols, particiones
+
+def actualizar_datos(estado):
+    """Revisa ./data por hash de contenido y recarga solo lo que cambió.
+
+    Se llama en cada rerun y devuelve la versión vigente de los datos
+    (``Datos``); la sesión debe usar esa misma versión durante todo el rerun.
+    Si un archivo no se puede cargar (p. ej. a medio escribir) se conservan los
+    datos anteriores, el error queda en ``Datos.errores`` y se reintenta solo
+    cuando cambia el contenido del archivo.
+    """
+    archivos = {ARCHIVO_BASE: None} | {archivo: nombre for nombre, archivo in CAPAS_GEOJSON.items()}
+    with estado["lock"]:
+        datos = estado["datos"]
+        campos = datos._asdict()
+        cambios = False
+        for archivo, nombre in archivos.items():
+            ruta = os.path.join(RUTA_DATOS, archivo)
+            anterior = estado["firmas"].get(archivo)
+            firma = firma_archivo(ruta, anterior)
+            if archivo in estado["firmas"] and (firma and firma[2]) == (anterior and anterior[2]):
+                estado["firmas"][archivo] = firma
+                continue
+            # Se registra la firma aunque falle la carga: un archivo roto que no
+            # cambia no se vuelve a leer en cada rerun
+            estado["firmas"][archivo] = firma
+            try:
+                if nombre is None:
+                    campos["tabla"], campos["ranking_cols"], campos["particiones"] = actualizar_tabla(datos, ruta)
+                else:
+                    # Recarga solo esta capa y, si es de puntos, sus particiones por EPS
+                    capa = cargar_geojson_local(ruta)
+                    campos["capas"] = campos["capas"] | {nombre: capa}
+                    campos["hashes"] = campos["hashes"] | {nombre: firma and firma[2]}
+                    if nombre in CAPAS_PUNTOS:
+                        puntos = particionar_puntos(capa, CAPAS_PUNTOS[nombre])
+                        campos["puntos"] = campos["puntos"] | {nombre: puntos}
+            except Exception as e:
+                campos["errores"] = campos["errores"] | {archivo: str(e)}
+                continue
+            campos["errores"] = {k: v for k, v in campos["errores"].items() if k != archivo}
+            cambios = True
+        if cambios:
+            campos["version"] = datos.version + 1
+        if cambios or campos["errores"] != datos.errores:
+            estado["datos"] = Datos(**campos)
+        return estado["datos"]
+
+def estilo_departamento(feature):
+    return {
+        "color": "black",
+        "weight": 1,
+        "fillOpacity": 0
+    }
+
+def estilo_casco_urbano(feature):
+    return {
+        "fillColor": "#A9A9A9",
+        "color": "black",
+        "weight": 1,
+        "fillOpacity": 0.4
+    }
+
+def estilo_casco_no_urbano(feature):
+    layer_value = feature["properties"].get("layer", "")
+    color = "#FFFF00" if layer_value == "A 2.5 Km del Área con población servida de la EPS" else "#87CEEB"
+    return {
+        "fillColor": color,
+        "color": "black",
+        "weight": 1,
+        "fillOpacity": 0.4
+    }
+
+# Capas comunes a todas las EPS: nombre -> (nombre en el control de capas, estilo)
+CAPAS_BASE = {
+    "departamento": ("Limite departamental", estilo_departamento),
+    "casco_urbano": ("Buffer_EPS_casco_urbano", estilo_casco_urbano),
+    "casco_no_urbano": ("Buffer EPS Lambayeque", estilo_casco_no_urbano)
+}
+
+def agregar_prestador(layer, row, color, radius):
+    # Crear contenido del popup
+    popup_content = f"""
+    <b>Prestador:</b> {row["Prestador"]}<br>
+    <b>Latitud:</b> {row["LATITUD"]}<br>
+    <b>Longitud:</b> {row["LONGITUD"]}
+    """
+    # Usar CircleMarker de folium directamente con add_child()
+    marker = folium.CircleMarker(
+        location=[row["LATITUD"], row["LONGITUD"]],
+        radius=radius,
+        color=color,
+        fill=True,
+        fill_color=color,
+        fill_opacity=0.7,
+        popup=folium.Popup(popup_content, max_width=300)
+    )
+    marker.add_to(layer)
+
+def nivel_grilla(zoom):
+    # Nivel de la pirámide para un zoom del mapa; None si se envían los puntos
+    if zoom >= ZOOM_PUNTOS:
+        return None
+    return max(nivel for nivel in NIVELES_GRILLA if nivel <= max(zoom, ZOOM_MIN))
+
+def construir_mapa(datos, df_filtered, selected_eps, top_n, zoom, capas_base=True, zoom_grilla=None):
+    """Mapa de la EPS centrado en sus prestadores; devuelve ``(mapa, control de capas)``.
+
+    Las capas de puntos se agregan según ``zoom_grilla`` (por defecto el zoom
+    inicial ``zoom``). Con ``capas_base=False`` se omiten los límites y
+    buffers comunes.
+    """
+    map_center = [df_filtered["LATITUD"].mean(), df_filtered["LONGITUD"].mean()]
+    m = leafmap.Map(center=map_center, zoom=zoom, min_zoom=ZOOM_MIN)  # Lima, Perú
+    nivel = nivel_grilla(zoom if zoom_grilla is None else zoom_grilla)
+    capas = datos.capas if capas_base else {}
+
+    # Limite Departamental
+    geojson_data = capas.get("departamento", {})
+    if isinstance(geojson_data, gpd.GeoDataFrame) and not geojson_data.empty:
+            # gdf = gpd.GeoDataFrame.from_features(geojson_data["features"])
+            gdf = geojson_data
+            m.add_geojson(
+                geojson_data,
+                layer_name=CAPAS_BASE["departamento"][0],
+                style_function=estilo_departamento
+            )
+            # Nombres en el centro de cada polígono
+            for _, row in gdf.iterrows():
+                centroide = row.geometry.centroid
+                nombre = row["nomdep"]
+                folium.Marker(
+                    location=[centroide.y, centroide.x],
+                    icon=folium.DivIcon(html=f"<div style='font-size: 10px; color: black;'>{nombre}</div>")
+                ).add_to(m)
+
+    # Buffer EPS casco urbano
+    geojson_data = capas.get("casco_urbano", {})
+    if isinstance(geojson_data, gpd.GeoDataFrame) and not geojson_data.empty:
+        m.add_geojson(
+                geojson_data,
+                layer_name=CAPAS_BASE["casco_urbano"][0],
+                style_function=estilo_casco_urbano
+            )
+
     
-# Configuración inicial de session_state
-if "geojson_data" not in st.session_state:
-    st.session_state["geojson_data"] = {
-        "datass": cargar_geojson_local("./data/datass.geojson", "datass"),
-        "departamento": cargar_geojson_local("./data/departamento.geojson", "departamento"),
-        "casco_urbano": cargar_geojson_local("./data/Buffer_EPS_casco_urbano.geojson", "casco_urbano"),
-        "casco_no_urbano": cargar_geojson_local("./data/Buffer_EPS_casco_no_urbano.geojson", "casco_no_urbano"),
-        "censo": cargar_geojson_local("./data/censo.geojson", "censo")
+    # Buffer EPS casco no urbano
+    geojson_data = capas.get("casco_no_urbano", {})
+    if isinstance(geojson_data, gpd.GeoDataFrame) and not geojson_data.empty:
+        m.add_geojson(
+                geojson_data,
+                layer_name=CAPAS_BASE["casco_no_urbano"][0],
+                style_function=estilo_casco_no_urbano
+        )
+
+    # Datass
+    layer_datass = folium.FeatureGroup(name=f"DATASS: {selected_eps}")
+    puntos_datass = datos.puntos.get("datass", {}).get(
+        selected_eps, pd.DataFrame(columns=["LONGITUD", "LATITUD"] + CAPAS_PUNTOS["datass"]))
+    if nivel is not None:
+        piramide = piramide_capa(puntos_datass, "datass", selected_eps, datos.hashes.get("datass"))
+        agregar_celdas(layer_datass, piramide.get(nivel, pd.DataFrame()), "blue")
+    else:
+        for _, row in puntos_datass.iterrows():
+            # Crear contenido del popup
+            popup_content = f"""
+            <b>Prestador:</b> {row["nomprest"]}<br>
+            <b>EPS:</b> {row["EPS1"]}
+            """
+            # Añadir un CircleMarker para cada punto filtrado
+            folium.CircleMarker(
+                location=[row["LATITUD"], row["LONGITUD"]],
+                radius=3,  # Tamaño del marcador
+                color="blue",
+                fill=True,
+                fill_color="blue",
+                fill_opacity=0.6,
+                popup=folium.Popup(popup_content, max_width=300)
+            ).add_to(layer_datass)
+
+    layer_datass.add_to(m)
+
+    # Censo
+    layer_censo = folium.FeatureGroup(name=f"CENSO: {selected_eps}")
+    puntos_censo = datos.puntos.get("censo", {}).get(
+        selected_eps, pd.DataFrame(columns=["LONGITUD", "LATITUD"] + CAPAS_PUNTOS["censo"]))
+    if nivel is not None:
+        piramide = piramide_capa(puntos_censo, "censo", selected_eps, datos.hashes.get("censo"))
+        agregar_celdas(layer_censo, piramide.get(nivel, pd.DataFrame()), "orange")
+    else:
+        for _, row in puntos_censo.iterrows():
+            # Crear contenido del popup
+            popup_content = f"""
+            <b>Centro Poblado:</b> {row["NOMCCPP"]}
+            """
+
+            # Añadir un CircleMarker para cada punto filtrado
+            folium.CircleMarker(
+                location=[row["LATITUD"], row["LONGITUD"]],
+                radius=3,  # Tamaño del marcador
+                color="orange",
+                fill=True,
+                fill_color="orange",
+                fill_opacity=0.6,
+                popup=folium.Popup(popup_content, max_width=300)
+            ).add_to(layer_censo)
+
+    layer_censo.add_to(m)
+
+    # Puntos con filtros y capas
+    layer_top_puntos = folium.FeatureGroup(name=f"SUNASS: {selected_eps}")
+    if nivel is not None:
+        # El Top N se mantiene como puntos individuales; solo se agrega el resto.
+        # Depende de los pesos, así que esta pirámide no se cachea.
+        for _, row in df_filtered.head(top_n).iterrows():
+            agregar_prestador(layer_top_puntos, row, "red", 6)
+        resto = df_filtered.iloc[top_n:][["LONGITUD", "LATITUD", "Ranking"]]
+        piramide = construir_piramide(resto, "Ranking")
+        agregar_celdas(layer_top_puntos, piramide.get(nivel, pd.DataFrame()), "green", "Ranking promedio")
+    else:
+        for idx, (_, row) in enumerate(df_filtered.iterrows()):
+            # Si el índice es menor que top_n, color rojo; de lo contrario, verde
+            color = "red" if idx < top_n else "green"
+            radius = 6 if idx < top_n else 4
+            agregar_prestador(layer_top_puntos, row, color, radius)
+
+    layer_top_puntos.add_to(m)
+    # Añadir control de capas
+    control = folium.LayerControl()
+    control.add_to(m)
+
+    legend_dict = {
+        f"Top {top_n}": "red",
+        "Caracterizacion": "green",
+        "DATASS": "blue",
+        "CENSO": "orange"
     }
 
+    # Añadir la leyenda al mapa
+    m.add_legend(title="Leyenda", legend_dict=legend_dict)
+
+    return m, control
 
 def main():
     st.set_page_config(page_title="Ranking de Prestadores", layout="wide")
     
-    # Configuración inicial de session_state
-    if "geojson_data" not in st.session_state:
-        st.session_state["geojson_data"] = {}
-
     st.title("🏆 Ranking de Prestadores de Servicios")
 
-    df, ranking_cols = load_data("./data/base_app_final.xlsx")
+    # Datos compartidos; se recargan solo si cambió algún archivo de ./data
+    datos = actualizar_datos(estado_datos())
+    for archivo, error in datos.errores.items():
+        st.warning(f"⚠️ Error al cargar {archivo}: {error}. Se mantienen los datos anteriores.")
+    if datos.tabla is None:
+        st.error(f"❌ No se pudo cargar {ARCHIVO_BASE}")
+        st.stop()
+    if st.session_state.get("version_datos", datos.version) != datos.version:
+        st.toast("🔄 Datos actualizados")
+    st.session_state["version_datos"] = datos.version
+    ranking_cols = datos.ranking_cols
     # st.sidebar.success("✅ Archivo cargado correctamente")
     
     st.sidebar.header("🔍 Filtrar por EPS")
-    eps_options = df["EPS"].unique().tolist()
+    eps_options = list(datos.particiones.keys())
     # selected_eps = st.sidebar.multiselect("Selecciona EPS", eps_options, default=eps_options)
     selected_eps = st.sidebar.selectbox("Selecciona EPS", eps_options)
 
@@ -159,14 +584,16 @@ def main():
     st.sidebar.header("⚖️ Ajustar Pesos")
     with st.sidebar.expander("🔧 Modificar pesos"):
         for col in ranking_cols:
-                st.session_state.weights[col] = st.slider(f"{col}", 1, 10, st.session_state.weights[col], 1)
+                peso = st.session_state.weights.get(col, default_weights.get(col, 1))
+                st.session_state.weights[col] = st.slider(f"{col}", 1, 10, peso, 1)
+        # Descartar pesos de columnas que ya no existen tras una recarga
+        st.session_state.weights = {col: st.session_state.weights[col] for col in ranking_cols}
 
         # Recalcular ranking inmediatamente cuando cambian los pesos
         # df_ranked = calculate_ranking(df, ranking_cols, st.session_state.weights)
-    df_ranked = calculate_sectional_ranking(df,ranking_cols,st.session_state.weights,sections)
-    
-    # df_filtered = df_ranked[df_ranked["EPS"].isin(selected_eps)]
-    df_filtered = df_ranked[df_ranked["EPS"] == selected_eps]
+    # El ranking es por fila: basta calcularlo sobre la partición de la EPS
+    df_eps = datos.particiones[selected_eps].reset_index()
+    df_filtered = calculate_sectional_ranking(df_eps,ranking_cols,st.session_state.weights,sections)
 
         # Configuración de layout en 2 columnas
     col1, col2 = st.columns([4.5, 2])  # Columna izquierda (ranking) | Derecha (mapa)
@@ -181,168 +608,23 @@ def main():
     with col1:
          
         st.subheader("🗺️ Mapa")
-        map_center = [df_filtered["LATITUD"].mean(), df_filtered["LONGITUD"].mean()]
-        m = leafmap.Map(center=map_center, zoom=12)  # Lima, Perú
-
-        # Limite Departamental
-        geojson_data = st.session_state["geojson_data"].get("departamento", {})
-        if isinstance(geojson_data, gpd.GeoDataFrame) and not geojson_data.empty:
-                # gdf = gpd.GeoDataFrame.from_features(geojson_data["features"])
-                gdf = geojson_data
-                m.add_geojson(
-                    geojson_data,
-                    layer_name="Limite departamental",
-                    style_function=lambda feature: {
-                        "color": "black",
-                        "weight": 1,
-                        "fillOpacity": 0
-                    }
-                )
-                # Nombres en el centro de cada polígono
-                for _, row in gdf.iterrows():
-                    centroide = row.geometry.centroid
-                    nombre = row["nomdep"]
-                    folium.Marker(
-                        location=[centroide.y, centroide.x],
-                        icon=folium.DivIcon(html=f"<div style='font-size: 10px; color: black;'>{nombre}</div>")
-                    ).add_to(m)
-
-        # Buffer EPS casco urbano
-        geojson_data = st.session_state["geojson_data"].get("casco_urbano", {})
-        if isinstance(geojson_data, gpd.GeoDataFrame) and not geojson_data.empty:
-            m.add_geojson(
-                    geojson_data,
-                    layer_name="Buffer_EPS_casco_urbano",
-                    style_function=lambda feature: {
-                        "fillColor": "#A9A9A9",
-                        "color": "black",
-                        "weight": 1,
-                        "fillOpacity": 0.4
-                    }
-                )
-
-        
-        # Buffer EPS casco no urbano
-        geojson_data = st.session_state["geojson_data"].get("casco_no_urbano", {})
-        if isinstance(geojson_data, gpd.GeoDataFrame) and not geojson_data.empty:
-            def buffer_style(feature):
-                    layer_value = feature["properties"].get("layer", "")
-                    color = "#FFFF00" if layer_value == "A 2.5 Km del Área con población servida de la EPS" else "#87CEEB"
-                    return {
-                        "fillColor": color,
-                        "color": "black",
-                        "weight": 1,
-                        "fillOpacity": 0.4
-                    }
-            m.add_geojson(
-                    geojson_data,
-                    layer_name="Buffer EPS Lambayeque",
-                    style_function=buffer_style
-            )
-
-        # Datass
-        geojson_data = st.session_state["geojson_data"].get("datass", {})
-        layer_datass = folium.FeatureGroup(name=f"DATASS: {selected_eps}")
-        if isinstance(geojson_data, gpd.GeoDataFrame) and not geojson_data.empty:
-                # Verifica si el GeoDataFrame tiene geometrías de tipo Point
-                points = geojson_data[geojson_data.geometry.type == "Point"]
-                
-                # Filtrar puntos según la selección de EPS
-                puntos_filtrados = points[points["EPS1"] == selected_eps]
-                
-                for _, row in puntos_filtrados.iterrows():
-                    lon, lat = row.geometry.x, row.geometry.y
-                    
-                    # Crear contenido del popup
-                    popup_content = f"""
-                    <b>Prestador:</b> {row["nomprest"]}<br>
-                    <b>EPS:</b> {row["EPS1"]}
-                    """
-                    # Añadir un CircleMarker para cada punto filtrado
-                    folium.CircleMarker(
-                        location=[lat, lon],
-                        radius=3,  # Tamaño del marcador
-                        color="blue",
-                        fill=True,
-                        fill_color="blue",
-                        fill_opacity=0.6,
-                        popup=folium.Popup(popup_content, max_width=300)
-                    ).add_to(layer_datass)
-
-        layer_datass.add_to(m)
-
-        # Censo
-        geojson_data = st.session_state["geojson_data"].get("censo", {})
-        layer_censo = folium.FeatureGroup(name=f"CENSO: {selected_eps}")
-        if isinstance(geojson_data, gpd.GeoDataFrame) and not geojson_data.empty:
-                # Verifica si el GeoDataFrame tiene geometrías de tipo Point
-                points = geojson_data[geojson_data.geometry.type == "Point"]
-                
-                # Filtrar puntos según la selección de EPS
-                puntos_filtrados = points[points["EPS1"] == selected_eps]
-                
-                for _, row in puntos_filtrados.iterrows():
-                    lon, lat = row.geometry.x, row.geometry.y
-
-                    # Crear contenido del popup
-                    popup_content = f"""
-                    <b>Centro Poblado:</b> {row["NOMCCPP"]}
-                    """
-                    
-                    # Añadir un CircleMarker para cada punto filtrado
-                    folium.CircleMarker(
-                        location=[lat, lon],
-                        radius=3,  # Tamaño del marcador
-                        color="orange",
-                        fill=True,
-                        fill_color="orange",
-                        fill_opacity=0.6,
-                        popup=folium.Popup(popup_content, max_width=300)
-                    ).add_to(layer_censo)
-
-        layer_censo.add_to(m)
-
-        # Puntos con filtros y capas
-        layer_top_puntos = folium.FeatureGroup(name=f"SUNASS: {selected_eps}")
-        for idx, row in enumerate(df_filtered.iterrows()):
-            # Si el índice es menor que 10, color rojo; de lo contrario, verde
-            color = "red" if idx <= top_n else "green"
-            radius = 6 if idx <= top_n else 4
-
-            # Crear contenido del popup
-            popup_content = f"""
-            <b>Prestador:</b> {row[1]["Prestador"]}<br>
-            <b>Latitud:</b> {row[1]["LATITUD"]}<br>
-            <b>Longitud:</b> {row[1]["LONGITUD"]}
-            """
-            # Usar CircleMarker de folium directamente con add_child()
-            marker = folium.CircleMarker(
-                location=[row[1]["LATITUD"], row[1]["LONGITUD"]],
-                radius=radius,
-                color=color,
-                fill=True,
-                fill_color=color,
-                fill_opacity=0.7,
-                popup=folium.Popup(popup_content, max_width=300)
-            )
-            marker.add_to(layer_top_puntos)
-
-        layer_top_puntos.add_to(m)
-        # Añadir control de capas
-        m.add_layer_control()
-
-        legend_dict = {
-            f"Top {top_n}": "red",
-            "Caracterizacion": "green",
-            "DATASS": "blue",
-            "CENSO": "orange"
-        }
-
-        # Añadir la leyenda al mapa
-        m.add_legend(title="Leyenda", legend_dict=legend_dict)
-
-        # Mostrar el mapa en Streamlit
-        m.to_streamlit(height=600)
+        # El mapa se construye con el zoom con el que se entró al nivel actual de
+        # la pirámide; así el componente no cambia (ni se vuelve a montar) hasta
+        # que cambia el nivel, y al montarse devuelve ese mismo zoom.
+        vista = st.session_state.get("vista_mapa", {})
+        if vista.get("eps") != selected_eps:
+            vista = {"eps": selected_eps, "zoom": ZOOM_INICIAL}
+        zoom = vista["zoom"]
+        m, _ = construir_mapa(datos, df_filtered, selected_eps, top_n, zoom)
+
+        # Solo se devuelve el zoom: moverse por el mapa no provoca un rerun
+        salida = st_folium(m, height=600, use_container_width=True, returned_objects=["zoom"])
+        zoom_actual = int(salida["zoom"]) if salida and salida.get("zoom") is not None else zoom
+        if nivel_grilla(zoom_actual) != nivel_grilla(zoom):
+            # Cambió el nivel de la pirámide: volver a renderizar con el nuevo zoom
+            st.session_state["vista_mapa"] = {"eps": selected_eps, "zoom": zoom_actual}
+            st.rerun()
+        st.session_state["vista_mapa"] = vista
 
     with st.expander("📋 Ver tabla de ranking", expanded=False):
             st.dataframe(df_top)